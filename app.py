@@ -1,21 +1,48 @@
-import subprocess
 import re
 import html
+import hashlib
 import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from dotenv import load_dotenv
+
+from langchain_openai import ChatOpenAI
+from langchain_community.vectorstores import Chroma
+
+# RAG scripts live in src/ and import their siblings by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import agentic_rag  # noqa: E402
+import vanilla_rag  # noqa: E402
+from embeddings import load_embeddings  # noqa: E402
+from faiss_store import FaissStore, index_exists  # noqa: E402
 
 st.set_page_config(page_title="Agentic RAG vs Vanilla RAG", layout="wide")
+load_dotenv()
 
 # ----------------------------
 # Helpers: clean + parse
 # ----------------------------
 ANSI_RE = re.compile(r"\x1b\[[0-9;]*m")
 ASK_LINE_RE = re.compile(r"^Ask a healthcare question:\s*", re.IGNORECASE)
-URL_RE = re.compile(r"https?://[^\s\)]+", re.IGNORECASE)
+URL_RE = re.compile(r"https?://[^\s\)\]>\"',]+", re.IGNORECASE)
+BLANK3_RE = re.compile(r"\n{3,}")
+TRAILING_WS_RE = re.compile(r"[^\S\n]+(?=\n|\Z)")
+# every separator str.splitlines() breaks on, mapped to "\n"
+LINE_BREAKS = str.maketrans(dict.fromkeys("\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029", "\n"))
+SOURCES_MARKER_RE = re.compile(
+    r"\n(?:Sources used|SOURCE URLs used|Sources considered|SOURCES|No sources found)"
+)
+SPLIT_HEADING_RE = re.compile(r"^\s*(\d+)[\)\.]\s*\n\s*\n\s*([^\n]+)\s*$", re.MULTILINE)
+BLANK_AFTER_HEADING_RE = re.compile(r"^(\d\)\s[^\n]+)\n\n+", re.MULTILINE)
 
 
 def clean_output(text: str) -> str:
-    t = ANSI_RE.sub("", text or "")
+    t = text or ""
+    if "\x1b" in t:
+        t = ANSI_RE.sub("", t)
     t = ASK_LINE_RE.sub("", t.lstrip())
     return t
 
@@ -26,10 +53,12 @@ def normalize_answer_spacing(text: str) -> str:
     and fix the '2.' then blank line then 'Causes...' pattern.
     """
     t = (text or "").replace("\r\n", "\n")
-    t = "\n".join(line.rstrip() for line in t.splitlines())
+    # break lines exactly where splitlines() would (lone \r, \f, ...)
+    t = t.replace("\r\n", "\n").translate(LINE_BREAKS)
+    t = TRAILING_WS_RE.sub("", t)
 
     # collapse 3+ blank lines
-    t = re.sub(r"\n{3,}", "\n\n", t)
+    t = BLANK3_RE.sub("\n\n", t)
 
     # join:
     #   2.
@@ -37,53 +66,32 @@ def normalize_answer_spacing(text: str) -> str:
     #   Causes / Risk factors
     # into:
     #   2) Causes / Risk factors
-    t = re.sub(
-        r"(?m)^\s*(\d+)[\)\.]\s*\n\s*\n\s*([^\n]+)\s*$",
-        r"\1) \2",
-        t,
-    )
+    t = SPLIT_HEADING_RE.sub(r"\1) \2", t)
 
     # remove extra blank lines right after headings like "1) Overview"
-    t = re.sub(r"(?m)^(\d\)\s[^\n]+)\n\n+", r"\1\n", t)
+    t = BLANK_AFTER_HEADING_RE.sub(r"\1\n", t)
 
     return t.strip()
 
 
 def parse_sources(text: str):
-    """Return unique base URLs (strip #fragment)."""
-    urls = URL_RE.findall(text or "")
-    seen, out = set(), []
-    for u in urls:
-        base = u.split("#")[0]
-        if base not in seen:
-            seen.add(base)
-            out.append(base)
-    return out
+    """Return unique base URLs (strip #fragment), in first-seen order."""
+    bases = (m.group(0).split("#", 1)[0] for m in URL_RE.finditer(text or ""))
+    return list(dict.fromkeys(bases))
 
 
 def split_answer_and_sources(clean_text: str):
     """
     Remove sources section from Answer tab to avoid duplication.
-    We split on common markers produced by your scripts.
+    We split on the first common marker produced by your scripts
+    (one scan for all markers).
     """
-    markers = [
-        "\nSources used",
-        "\nSOURCE URLs used",
-        "\nSources considered",
-        "\nSOURCES",
-        "\nSources used (unique",
-        "\nNo sources found",
-    ]
-    idx = None
-    for m in markers:
-        pos = clean_text.find(m)
-        if pos != -1:
-            idx = pos
-            break
-
-    if idx is None:
+    m = SOURCES_MARKER_RE.search(clean_text)
+    if m is None:
         return clean_text.strip(), ""
 
+    idx = m.start()
+
     answer_part = clean_text[:idx].strip()
     sources_part = clean_text[idx:].strip()
     return answer_part, sources_part
@@ -285,33 +293,88 @@ if clear_btn:
 # ----------------------------
 # Runner
 # ----------------------------
-def run_script(script_path: str, q: str) -> str:
+@st.cache_resource(show_spinner=False)
+def get_llm() -> ChatOpenAI:
+    """One ChatOpenAI client for the whole Streamlit server."""
+    # Same 120s ceiling the old subprocess call had, so a stalled request
+    # surfaces as an error instead of an endless spinner
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0, timeout=120, max_retries=2)
+
+
+@st.cache_resource(show_spinner=False)
+def get_db() -> Chroma:
+    """Load MiniLM + open chroma_db once, instead of per question."""
+    emb = load_embeddings()
+    return Chroma(persist_directory="chroma_db", embedding_function=emb)
+
+
+@st.cache_resource(show_spinner=False)
+def get_vanilla_db():
+    """Vanilla only needs single-vector search: use the FAISS export if built."""
+    db = get_db()
+    return FaissStore(db.embeddings) if index_exists() else db
+
+
+PIPELINES = {m.__name__: m for m in (vanilla_rag, agentic_rag)}
+
+
+@st.cache_data(ttl=3600, max_entries=256, show_spinner=False)
+def cached_answer(rag_name: str, q_hash: str, _q: str, _llm: ChatOpenAI, _db: Chroma, _on_token=None) -> str:
     """
-    Run a Python script with the question via stdin.
-    Return stdout OR a friendly error message.
+    Memoize answer() per (pipeline, prompt hash).
+    The prompt already embeds the conversation history, so follow-ups
+    get their own entries. Underscore args are not hashed by Streamlit.
+    Exceptions propagate, so failures are never cached.
+    On a hit nothing is streamed to `_on_token`.
     """
-    env = os.environ.copy()
-    env["PYTHONIOENCODING"] = "utf-8"
-    env["PYTHONUNBUFFERED"] = "1"
-
-    p = subprocess.run(
-        ["uv", "run", "python", script_path],
-        input=(q + "\n"),
-        text=True,
-        capture_output=True,
-        shell=False,
-        timeout=120,
-        encoding="utf-8",
-        errors="replace",
-        env=env,
-    )
-
-    if p.returncode != 0:
-        err = clean_output(p.stderr)
-        out = clean_output(p.stdout)
-        return f"⚠️ Error running {script_path}\n\n{err}\n\n{out}".strip()
-
-    return p.stdout
+    return PIPELINES[rag_name].answer(_q, _llm, _db, on_token=_on_token)
+
+
+def run_pipeline(rag, q: str, llm: ChatOpenAI, db: Chroma, on_token=None) -> str:
+    """
+    Run a RAG module's answer() in-process with the given LLM + DB.
+    Return its (possibly cached) output OR a friendly error message.
+    """
+    try:
+        q_hash = hashlib.blake2b(q.encode("utf-8"), digest_size=16).hexdigest()
+        return cached_answer(rag.__name__, q_hash, q, llm, db, on_token)
+    except Exception as e:
+        return f"⚠️ Error running {rag.__name__}\n\n{clean_output(str(e))}".strip()
+
+
+def script_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Thread pool whose workers inherit this run's ScriptRunContext (needed by st.cache_*)."""
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=add_script_run_ctx, initargs=(None, ctx))
+
+
+def stream_pipeline(rag, q: str, llm: ChatOpenAI, db: Chroma) -> str:
+    """
+    Like run_pipeline, but shows the answer live while the model writes it.
+    The pipeline runs in a worker thread and pushes tokens into a queue;
+    this (script) thread drains it through st.write_stream. The preview
+    is cleared afterwards: render_result shows the final, cleaned output.
+    """
+    tokens: queue.Queue[str] = queue.Queue()
+    preview = st.empty()
+
+    with script_executor(1) as ex:
+        fut = ex.submit(run_pipeline, rag, q, llm, db, tokens.put)
+
+        def drain():
+            # fut.done() is checked first: once it's True, every token is queued
+            while not fut.done() or not tokens.empty():
+                try:
+                    yield tokens.get(timeout=0.05)
+                except queue.Empty:
+                    continue
+
+        with preview.container():
+            st.write_stream(drain())
+        out = fut.result()
+
+    preview.empty()
+    return out
 
 
 def render_result(title: str, raw_out: str):
@@ -361,22 +424,33 @@ if run_btn:
         st.stop()
 
     combined_question = build_followup_prompt(user_q, st.session_state.history, max_turns=4)
-    st.session_state.show_results = True
-
     with st.spinner("🔄 Processing..."):
+        # Resolve cached handles on the script thread, then share them
+        try:
+            llm, db, vdb = get_llm(), get_db(), get_vanilla_db()
+        except Exception as e:
+            st.error(f"⚠️ Could not load the LLM or vector store\n\n{clean_output(str(e))}")
+            st.stop()
+
+        st.session_state.show_results = True
+
         if mode == "Vanilla":
-            out = run_script("src/vanilla_rag.py", combined_question)
+            out = stream_pipeline(vanilla_rag, combined_question, llm, vdb)
             st.session_state.last_vanilla = out
             st.session_state.history.append({"q": user_q, "a": clean_output(out)})
 
         elif mode == "Agentic":
-            out = run_script("src/agentic_rag.py", combined_question)
+            out = stream_pipeline(agentic_rag, combined_question, llm, db)
             st.session_state.last_agentic = out
             st.session_state.history.append({"q": user_q, "a": clean_output(out)})
 
         else:
-            out_v = run_script("src/vanilla_rag.py", combined_question)
-            out_a = run_script("src/agentic_rag.py", combined_question)
+            # Both pipelines are network-bound on OpenAI: overlap them
+            # (each side is cached separately)
+            with script_executor(2) as ex:
+                fv = ex.submit(run_pipeline, vanilla_rag, combined_question, llm, vdb)
+                fa = ex.submit(run_pipeline, agentic_rag, combined_question, llm, db)
+                out_v, out_a = fv.result(), fa.result()
             st.session_state.last_vanilla = out_v
             st.session_state.last_agentic = out_a
             merged = f"[Vanilla]\n{clean_output(out_v)}\n\n[Agentic]\n{clean_output(out_a)}"
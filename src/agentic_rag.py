@@ -3,70 +3,91 @@ from __future__ import annotations
 
 import re
 import sys
-from typing import List, Tuple, Dict
+from functools import lru_cache
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 from dotenv import load_dotenv
 
 from langchain_openai import ChatOpenAI
 from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_core.documents import Document
+from pydantic import BaseModel, Field
+
+from embeddings import load_embeddings
 
 
 # ----------------------------
 # Question extraction (works with your app’s multi-line stdin)
 # ----------------------------
-QUESTION_MARKERS = [r"\bQUESTION:\s*", r"\bNew question:\s*"]
+# "QUESTION:" / "New question:" as one alternation -> one scan of the input
+QUESTION_MARKER_RE = re.compile(r"\b(?:QUESTION|New question):\s*", re.IGNORECASE)
+WS_RE = re.compile(r"\s+")
 
+# Reruns resend the same history-expanded block verbatim
+@lru_cache(maxsize=128)
 def extract_last_question(stdin_text: str) -> str:
     t = (stdin_text or "").strip()
     if "\n" not in t and len(t) < 400:
-        return re.sub(r"\s+", " ", t).strip()
-
-    last_pos, last_len = -1, 0
-    for pat in QUESTION_MARKERS:
-        matches = list(re.finditer(pat, t, flags=re.IGNORECASE))
-        if matches:
-            m = matches[-1]
-            if m.start() > last_pos:
-                last_pos, last_len = m.start(), len(m.group(0))
-
-    if last_pos >= 0:
-        q = t[last_pos + last_len :].strip()
+        return WS_RE.sub(" ", t).strip()
+
+    # keep only the rightmost marker; no match list is materialized
+    last = None
+    for m in QUESTION_MARKER_RE.finditer(t):
+        last = m
+
+    if last is not None:
+        q = t[last.end() :].strip()
     else:
-        lines = [x.strip() for x in t.splitlines() if x.strip()]
-        q = lines[-1] if lines else ""
+        # last non-empty line, walking back from the end (no line list)
+        q = ""
+        end = len(t)
+        while end > 0:
+            nl = t.rfind("\n", 0, end)
+            q = t[nl + 1 : end].strip()
+            if q:
+                break
+            end = nl
 
-    return re.sub(r"\s+", " ", q).strip()
+    return WS_RE.sub(" ", q).strip()
 
 
 # ----------------------------
 # URL helpers
 # ----------------------------
-def base_url(url: str) -> str:
-    return (url or "").split("#")[0].strip()
-
 def is_medline(url: str) -> bool:
-    return "medlineplus.gov" in (url or "").lower()
+    # crawler canonicalizes hosts to lowercase, so no per-call .lower()
+    return "medlineplus.gov" in (url or "")
 
 
 # ----------------------------
 # 🔒 HARD formatting enforcement: NO blank lines between sections
 # ----------------------------
+SPLIT_HEADING_RE = re.compile(r"^\s*(\d+)\s*[\.\)]\s*\n\s*([A-Za-z])", re.MULTILINE)
+NUMBERED_HEADING_RE = re.compile(r"^\s*(\d+)[\.\)]\s*", re.MULTILINE)
+BLANK_AFTER_HEADING_RE = re.compile(r"(\d\)\s[^\n]+)\n\s*\n+", re.MULTILINE)
+MULTI_NL_RE = re.compile(r"\n{2,}")
+MULTI_NL3_RE = re.compile(r"\n{3,}")
+TRAILING_WS_RE = re.compile(r"[^\S\n]+(?=\n|\Z)")
+# every separator str.splitlines() breaks on, mapped to "\n"
+LINE_BREAKS = str.maketrans(dict.fromkeys("\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029", "\n"))
+
+@lru_cache(maxsize=128)
 def normalize_answer(ans: str) -> str:
     t = (ans or "").replace("\r\n", "\n")
-    t = "\n".join(line.rstrip() for line in t.splitlines())
+    # break lines exactly where splitlines() would (lone \r, \f, ...)
+    t = t.replace("\r\n", "\n").translate(LINE_BREAKS)
+    t = TRAILING_WS_RE.sub("", t)
 
     # Fix split headings like:
     # 2.
     # Causes ...
-    t = re.sub(r"(?m)^\s*(\d+)\s*[\.\)]\s*\n\s*([A-Za-z])", r"\1) \2", t)
-    t = re.sub(r"(?m)^\s*(\d+)[\.\)]\s*", r"\1) ", t)
+    t = SPLIT_HEADING_RE.sub(r"\1) \2", t)
+    t = NUMBERED_HEADING_RE.sub(r"\1) ", t)
 
     # Remove blank lines after headings (critical)
-    t = re.sub(r"(?m)(\d\)\s[^\n]+)\n\s*\n+", r"\1\n", t)
+    t = BLANK_AFTER_HEADING_RE.sub(r"\1\n", t)
 
     # Collapse any remaining extra newlines globally
-    t = re.sub(r"\n{2,}", "\n", t)
+    t = MULTI_NL_RE.sub("\n", t)
 
     return t.strip()
 
@@ -74,12 +95,57 @@ def normalize_answer(ans: str) -> str:
 # ----------------------------
 # Retrieval helpers
 # ----------------------------
-def retrieve(db: Chroma, query: str, k: int = 60) -> List[Tuple[Document, float]]:
+class RetrievalError(RuntimeError):
+    """Embedding or Chroma query failed (as opposed to finding nothing)."""
+
+
+def retrieve_many(db: Chroma, queries: List[str], k: int = 60) -> List[Tuple[Document, float]]:
+    """
+    Embed all queries in ONE batch and run ONE Chroma query for them.
+    Returns the (doc, distance) pool across all queries, already
+    deduplicated by chunk id (best distance wins).
+    Raises RetrievalError on failure, so callers (and the app's answer
+    cache) never mistake an outage for "Not enough information".
+    """
+    if not queries:
+        return []
     try:
-        return db.similarity_search_with_score(query, k=k)
+        qvecs = db.embeddings.embed_documents(queries)
+        res = db._collection.query(
+            query_embeddings=qvecs,
+            n_results=k,
+            include=["documents", "metadatas", "distances"],
+        )
     except Exception as e:
-        print(f"ERROR: retrieval failed: {e}", file=sys.stderr)
-        return []
+        raise RetrievalError(f"retrieval failed: {e}") from e
+
+    # Overlapping section queries return the same chunks; keep one entry each
+    best: Dict[str, Tuple[Document, float]] = {}
+    for ids, texts, metas, dists in zip(res["ids"], res["documents"], res["metadatas"], res["distances"]):
+        for cid, text, meta, dist in zip(ids, texts, metas, dists):
+            prev = best.get(cid)
+            if prev is None or dist < prev[1]:
+                best[cid] = (Document(id=cid, page_content=text or "", metadata=meta or {}), dist)
+    return list(best.values())
+
+
+def retrieve(db: Chroma, query: str, k: int = 60) -> List[Tuple[Document, float]]:
+    return retrieve_many(db, [query], k=k)
+
+
+def dedupe_chunks(results: List[Tuple[Document, float]]) -> List[Tuple[Document, float]]:
+    """
+    Keep only the best (lowest score) hit per chunk id.
+    Section queries overlap a lot, so this shrinks the pool before
+    the per-URL grouping has to parse each source.
+    """
+    best: Dict[object, Tuple[Document, float]] = {}
+    for d, s in results:
+        key = d.id or id(d)
+        cur = best.get(key)
+        if cur is None or s < cur[1]:
+            best[key] = (d, s)
+    return list(best.values())
 
 
 def group_best_chunk_per_url(
@@ -91,8 +157,14 @@ def group_best_chunk_per_url(
     """
     best: Dict[str, Tuple[Document, float]] = {}
     for d, s in results:
-        u = base_url(d.metadata.get("source", ""))
-        if not u or not is_medline(u):
+        meta = d.metadata
+        u = meta.get("source")  # canonical page URL (crawler strips fragments)
+        if not u:
+            continue
+        medline = meta.get("is_medline")
+        if medline is None:  # chunk ingested before is_medline was stored
+            medline = is_medline(u)
+        if not medline:
             continue
         if u not in best or s < best[u][1]:
             best[u] = (d, s)
@@ -119,60 +191,50 @@ def select_top_k(grouped: List[Tuple[Document, float, str]], k: int = 5) -> List
 
 
 def build_context(picked: List[Tuple[Document, float, str]], max_chars: int = 8000, per_source: int = 1400) -> str:
-    blocks = []
+    # Write blocks until the budget is hit instead of join-then-slice
+    buf: List[str] = []
+    total = 0
     for d, _, u in picked:
-        text = re.sub(r"\n{3,}", "\n", (d.page_content or "").strip())
-        blocks.append(f"SOURCE: {u}\n{text[:per_source]}")
-    return "\n".join(blocks)[:max_chars]
+        text = MULTI_NL3_RE.sub("\n", (d.page_content or "").strip())
+        block = f"SOURCE: {u}\n{text[:per_source]}"
+        if buf:
+            block = "\n" + block
+        room = max_chars - total
+        if len(block) >= room:
+            buf.append(block[:room])
+            break
+        buf.append(block)
+        total += len(block)
+    return "".join(buf)
 
 
 # ----------------------------
 # Agentic step: make section-specific queries
 # ----------------------------
+class SectionQueries(BaseModel):
+    """One short MedlinePlus search query per answer section."""
+    overview: str = Field(description="Query for a general overview")
+    causes: str = Field(description="Query for causes / risk factors")
+    symptoms: str = Field(description="Query for symptoms")
+    diagnosis: str = Field(description="Query for diagnosis / tests")
+    treatment: str = Field(description="Query for treatment / management")
+    urgent: str = Field(description="Query for when to seek urgent care")
+
+
 def section_queries(llm: ChatOpenAI, question: str) -> Dict[str, str]:
     msg = f"""Create 6 short search queries to retrieve MedlinePlus info for this medical question.
 
 Question: {question}
 
-Return EXACTLY 6 lines in this format:
-Overview: ...
-Causes: ...
-Symptoms: ...
-Diagnosis: ...
-Treatment: ...
-Urgent: ...
-
 Rules:
+- One query per field: overview, causes, symptoms, diagnosis, treatment, urgent.
 - Each query should be 5–12 words.
 - Include key medical terms from the question.
-- No extra text.
 """
     try:
-        out = llm.invoke(msg).content.strip()
+        out = llm.with_structured_output(SectionQueries).invoke(msg)
     except Exception:
-        out = ""
-
-    mapping: Dict[str, str] = {}
-    for line in out.splitlines():
-        if ":" not in line:
-            continue
-        k, v = line.split(":", 1)
-        key = k.strip().lower()
-        val = v.strip()
-        if not val:
-            continue
-        if key.startswith("overview"):
-            mapping["Overview"] = val
-        elif key.startswith("causes"):
-            mapping["Causes"] = val
-        elif key.startswith("symptoms"):
-            mapping["Symptoms"] = val
-        elif key.startswith("diagnosis"):
-            mapping["Diagnosis"] = val
-        elif key.startswith("treatment"):
-            mapping["Treatment"] = val
-        elif key.startswith("urgent"):
-            mapping["Urgent"] = val
+        out = None
 
     defaults = {
         "Overview": question,
@@ -182,18 +244,20 @@ Rules:
         "Treatment": f"{question} treatment management",
         "Urgent": f"{question} emergency when to seek help",
     }
-    for k, v in defaults.items():
-        mapping.setdefault(k, v)
+    if out is None:
+        return defaults
 
-    return mapping
+    fields = out.model_dump()
+    return {k: (fields[k.lower()] or "").strip() or v for k, v in defaults.items()}
 
 
 # ----------------------------
 # Answer generation
 # ----------------------------
-def generate_answer(llm: ChatOpenAI, question: str, context: str) -> str:
+def generate_answer_stream(llm: ChatOpenAI, question: str, context: str) -> Iterator[str]:
+    """Yield raw answer tokens as the model produces them (not normalized)."""
     if not context.strip():
-        return normalize_answer(
+        yield (
             "1) Overview\nNot enough information in the retrieved pages.\n"
             "2) Causes / Risk factors\nNot enough information in the retrieved pages.\n"
             "3) Symptoms\nNot enough information in the retrieved pages.\n"
@@ -201,6 +265,7 @@ def generate_answer(llm: ChatOpenAI, question: str, context: str) -> str:
             "5) Treatment / What you can do\nNot enough information in the retrieved pages.\n"
             "6) When to seek urgent care\nNot enough information in the retrieved pages."
         )
+        return
 
     msg = f"""You are a careful medical information assistant.
 
@@ -225,58 +290,97 @@ CONTEXT:
 QUESTION:
 {question}
 """
-    return normalize_answer(llm.invoke(msg).content)
+    for chunk in llm.stream(msg):
+        if chunk.content:
+            yield chunk.content
+
+
+def generate_answer(
+    llm: ChatOpenAI,
+    question: str,
+    context: str,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Stream the answer (forwarding tokens to `on_token`), normalize once at the end."""
+    parts: List[str] = []
+    for tok in generate_answer_stream(llm, question, context):
+        parts.append(tok)
+        if on_token is not None:
+            on_token(tok)
+    return normalize_answer("".join(parts))
 
 
 # ----------------------------
-# Main
+# Pipeline
 # ----------------------------
-def main():
-    if sys.stdout.encoding != "utf-8":
-        sys.stdout.reconfigure(encoding="utf-8", errors="replace")
-    if sys.stderr.encoding != "utf-8":
-        sys.stderr.reconfigure(encoding="utf-8", errors="replace")
-
-    load_dotenv()
-
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+def format_sources(picked: List[Tuple[Document, float, str]]) -> str:
+    lines = ["Sources used (5 unique)"]
+    if not picked:
+        lines.append("No sources found.")
+    else:
+        for i, (_, s, u) in enumerate(picked[:5], 1):
+            lines.append(f"{i}. {u} (similarity: {s:.3f})")
+    return "\n".join(lines)
 
-    emb = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = Chroma(persist_directory="chroma_db", embedding_function=emb)
 
-    question = extract_last_question(sys.stdin.read())
+def answer(
+    question: str,
+    llm: ChatOpenAI,
+    db: Chroma,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Run the full agentic pipeline with already-loaded LLM + vector store.
+    Accepts a bare question or the app's multi-line prompt block.
+    Raw answer tokens are passed to `on_token` as they stream in.
+    Returns the answer followed by the sources section.
+    """
+    question = extract_last_question(question)
     if not question:
-        print("ERROR: No question provided.", file=sys.stderr)
-        sys.exit(1)
+        raise ValueError("No question provided.")
 
     # Agentic: section-based retrieval pool
     sq = section_queries(llm, question)
 
-    pool: List[Tuple[Document, float]] = []
-    for _, q in sq.items():
-        pool.extend(retrieve(db, q, k=60))
+    pool = retrieve_many(db, list(sq.values()), k=60)
 
     grouped = group_best_chunk_per_url(pool)
     picked = select_top_k(grouped, k=5)
 
-    # If still not enough, do one broader hop
+    # If still not enough, do one broader hop (only the new query is embedded)
     if len(picked) < 5:
         expanded = f"{question} symptoms causes diagnosis treatment emergency"
-        pool2 = pool + retrieve(db, expanded, k=120)
+        pool2 = dedupe_chunks(pool + retrieve(db, expanded, k=120))
         grouped2 = group_best_chunk_per_url(pool2)
         picked = select_top_k(grouped2, k=5)
 
     ctx = build_context(picked, max_chars=8000, per_source=1400)
-    ans = generate_answer(llm, question, ctx)
+    ans = generate_answer(llm, question, ctx, on_token=on_token)
 
-    print(ans)
+    return f"{ans}\n\n{format_sources(picked)}"
 
-    print("\nSources used (5 unique)")
-    if not picked:
-        print("No sources found.")
-    else:
-        for i, (_, s, u) in enumerate(picked[:5], 1):
-            print(f"{i}. {u} (similarity: {s:.3f})")
+
+# ----------------------------
+# Main
+# ----------------------------
+def main():
+    if sys.stdout.encoding != "utf-8":
+        sys.stdout.reconfigure(encoding="utf-8", errors="replace")
+    if sys.stderr.encoding != "utf-8":
+        sys.stderr.reconfigure(encoding="utf-8", errors="replace")
+
+    load_dotenv()
+
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+    emb = load_embeddings()
+    db = Chroma(persist_directory="chroma_db", embedding_function=emb)
+
+    try:
+        print(answer(sys.stdin.read(), llm, db))
+    except (ValueError, RetrievalError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
 
 
 if __name__ == "__main__":
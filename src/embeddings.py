@@ -0,0 +1,115 @@
+# src/embeddings.py
+from __future__ import annotations
+
+import os
+from functools import lru_cache
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import FastEmbedEmbeddings
+
+EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# int8 export of EMBED_MODEL (see quantize_model below)
+ONNX_DIR = "onnx_minilm"
+ONNX_FP32_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+MAX_SEQ_LEN = 256  # same as sentence-transformers' max_seq_length for MiniLM-L6
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps another Embeddings and memoizes embed_query (text -> vector),
+    so a repeated question skips the MiniLM forward pass.
+    embed_documents is passed through untouched.
+    """
+
+    def __init__(self, inner: Embeddings, maxsize: int = 1024):
+        self.inner = inner
+        self._embed_query = lru_cache(maxsize=maxsize)(self._embed_query_uncached)
+
+    def _embed_query_uncached(self, text: str) -> tuple[float, ...]:
+        # tuples: cached vectors must not be mutable by callers
+        return tuple(self.inner.embed_query(text))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return list(self._embed_query(text))
+
+
+class OnnxInt8Embeddings(Embeddings):
+    """
+    MiniLM-L6 with int8 dynamically-quantized weights on ONNX Runtime (CPU).
+    Mean pooling + L2 normalization, matching sentence-transformers output.
+    """
+
+    def __init__(self, model_dir: str = ONNX_DIR, batch_size: int = 32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_INT8_FILE), providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=MAX_SEQ_LEN)
+        self.tokenizer.enable_padding(pad_id=0, pad_token="[PAD]")
+        self.batch_size = batch_size
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        import numpy as np
+
+        enc = self.tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in enc], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in enc], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in enc], dtype=np.int64),
+        }
+        feeds = {k: v for k, v in feeds.items() if k in self.input_names}
+
+        hidden = self.session.run(None, feeds)[0]  # (batch, seq, 384)
+        mask = feeds["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+        return pooled.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        out: List[List[float]] = []
+        for i in range(0, len(texts), self.batch_size):
+            out.extend(self._embed(texts[i : i + self.batch_size]))
+        return out
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0]
+
+
+def quantize_model(model_dir: str = ONNX_DIR) -> str:
+    """
+    One-time int8 dynamic quantization of an ONNX MiniLM export.
+    Export first (also writes tokenizer.json next to model.onnx); the
+    exporter lives in the optional `onnx-export` extra:
+        uv run --extra onnx-export optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 onnx_minilm/
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    out = os.path.join(model_dir, ONNX_INT8_FILE)
+    quantize_dynamic(os.path.join(model_dir, ONNX_FP32_FILE), out, weight_type=QuantType.QInt8)
+    return out
+
+
+def load_embeddings() -> CachedQueryEmbeddings:
+    """
+    MiniLM-L6 on ONNX Runtime, no torch: the int8 export if it has been
+    built (see quantize_model), otherwise fastembed's FP32 ONNX model.
+    Same weights either way, so query vectors stay comparable with chunks
+    embedded by the other backend or the old HuggingFace path.
+    """
+    if os.path.exists(os.path.join(ONNX_DIR, ONNX_INT8_FILE)):
+        return CachedQueryEmbeddings(OnnxInt8Embeddings(ONNX_DIR))
+    return CachedQueryEmbeddings(FastEmbedEmbeddings(model_name=EMBED_MODEL))
+
+
+if __name__ == "__main__":
+    print(f"Wrote {quantize_model()}")
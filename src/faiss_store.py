@@ -0,0 +1,118 @@
+# src/faiss_store.py
+"""
+Read-only FAISS HNSW index over the chunks in chroma_db.
+
+The MedlinePlus corpus is static between ingests, so we export Chroma's
+stored vectors once into a FAISS file (+ a JSONL side file with
+page_content/metadata) and query that at runtime instead of Chroma.
+Both are small and loaded fully into RAM (HNSW indexes are not mmapped).
+
+Build / rebuild (ingest.py also does this):
+    uv run python src/faiss_store.py
+"""
+from __future__ import annotations
+
+import json
+import os
+from typing import TYPE_CHECKING, List, Tuple
+
+if TYPE_CHECKING:
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import Embeddings
+
+FAISS_DIR = "faiss_db"
+INDEX_FILE = "index.faiss"
+META_FILE = "meta.jsonl"
+
+
+def build_index(persist_directory: str = "chroma_db", out_dir: str = FAISS_DIR) -> int:
+    """
+    Export every vector in the Chroma collection into an HNSW index.
+    Returns the number of vectors written.
+    """
+    import faiss
+    import numpy as np
+    from langchain_community.vectorstores import Chroma
+
+    data = Chroma(persist_directory=persist_directory)._collection.get(
+        include=["embeddings", "documents", "metadatas"]
+    )
+    vecs = np.asarray(data["embeddings"], dtype=np.float32)
+    if vecs.ndim != 2 or not len(vecs):
+        raise ValueError(f"No vectors found in {persist_directory}")
+
+    # Same (squared) L2 distance Chroma uses, so score margins still apply
+    index = faiss.IndexHNSWFlat(vecs.shape[1], 32)
+    index.hnsw.efConstruction = 200
+    index.add(vecs)
+
+    os.makedirs(out_dir, exist_ok=True)
+    faiss.write_index(index, os.path.join(out_dir, INDEX_FILE))
+
+    # Row i of the index <-> line i of the JSONL file
+    with open(os.path.join(out_dir, META_FILE), "w", encoding="utf-8") as f:
+        for cid, text, meta in zip(data["ids"], data["documents"], data["metadatas"]):
+            f.write(json.dumps({"id": cid, "text": text or "", "metadata": meta or {}}) + "\n")
+
+    return len(vecs)
+
+
+class FaissStore:
+    """
+    Minimal stand-in for the Chroma methods the vanilla pipeline uses:
+    `embeddings` and `similarity_search_by_vector_with_relevance_scores`.
+    """
+
+    def __init__(self, embedding_function: Embeddings, index_dir: str = FAISS_DIR):
+        import faiss
+
+        index_path = os.path.join(index_dir, INDEX_FILE)
+        self._index = faiss.read_index(index_path)
+        with open(os.path.join(index_dir, META_FILE), encoding="utf-8") as f:
+            self._rows = [json.loads(line) for line in f]
+        self._embedding_function = embedding_function
+        # Used by the retrieval cache to drop entries after a rebuild
+        self.version = f"faiss:{os.path.getmtime(index_path)}:{self._index.ntotal}"
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def similarity_search_by_vector_with_relevance_scores(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        import faiss
+        import numpy as np
+        from langchain_core.documents import Document
+
+        # HNSW needs efSearch >= k to return k neighbours; pass it per call
+        # (not via index.hnsw) so concurrent searches don't race on it
+        params = faiss.SearchParametersHNSW(efSearch=max(64, k))
+        dists, ids = self._index.search(np.asarray([embedding], dtype=np.float32), k, params=params)
+
+        out: List[Tuple[Document, float]] = []
+        for i, dist in zip(ids[0], dists[0]):
+            if i < 0:  # fewer than k vectors in the index
+                continue
+            row = self._rows[i]
+            out.append((Document(id=row["id"], page_content=row["text"], metadata=row["metadata"]), float(dist)))
+        return out
+
+
+def index_exists(index_dir: str = FAISS_DIR) -> bool:
+    return os.path.exists(os.path.join(index_dir, INDEX_FILE))
+
+
+def load_vector_store(embedding_function: Embeddings, persist_directory: str = "chroma_db"):
+    """FaissStore if the index has been built, otherwise the Chroma DB itself."""
+    if index_exists():
+        return FaissStore(embedding_function)
+
+    from langchain_community.vectorstores import Chroma
+
+    return Chroma(persist_directory=persist_directory, embedding_function=embedding_function)
+
+
+if __name__ == "__main__":
+    n = build_index()
+    print(f"Wrote {n} vectors to ./{FAISS_DIR}")
@@ -9,7 +9,8 @@ from langchain_community.vectorstores import Chroma
 from langchain_core.documents import Document
 
 from scrape import crawl_site
-from langchain_community.embeddings import HuggingFaceEmbeddings
+from embeddings import load_embeddings
+from faiss_store import FAISS_DIR, build_index
 
 
 def main():
@@ -45,8 +46,16 @@ def main():
     # Crawl with extra seeds (your updated scrape.py supports extra_seeds)
     pages = crawl_site(base_url, max_pages=40, extra_seeds=extra_seeds)
 
+    # Crawled URLs are already canonical (no fragment, lowercased host), so
+    # "source" is the page key as-is; precompute the MedlinePlus test once
     docs = [
-        Document(page_content=p["text"], metadata={"source": p["url"]})
+        Document(
+            page_content=p["text"],
+            metadata={
+                "source": p["url"],
+                "is_medline": "medlineplus.gov" in p["url"],
+            },
+        )
         for p in pages
     ]
 
@@ -56,9 +65,11 @@ def main():
     )
     chunks = splitter.split_documents(docs)
 
-    emb = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    emb = load_embeddings()
 
-    # Rebuild the DB in ./chroma_db
+    # Rebuild the DB in ./chroma_db: from_documents appends to the existing
+    # collection, so drop it first or a re-ingest duplicates every chunk
+    Chroma(persist_directory="chroma_db", embedding_function=emb).delete_collection()
     db = Chroma.from_documents(
         documents=chunks,
         embedding=emb,
@@ -67,6 +78,10 @@ def main():
     db.persist()
 
     print(f"Ingested pages={len(pages)}, chunks={len(chunks)} into ./chroma_db")
+
+    # Keep the read-only FAISS export in sync with the new vectors
+    n = build_index("chroma_db")
+    print(f"Exported {n} vectors to ./{FAISS_DIR}")
     print("Sample sources:")
     for u in [p["url"] for p in pages[:10]]:
         print(" -", u)
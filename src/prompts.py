@@ -1,12 +1,9 @@
-VANILLA_TEMPLATE = """You are a helpful assistant.
+# Static instructions go in the system message, the per-request context +
+# question in the user message. (The static part is far below OpenAI's
+# 1024-token prompt-caching minimum, so this layout is not a caching win.)
+VANILLA_SYSTEM_PROMPT = """You are a helpful assistant.
 Use ONLY the context to answer.
 
-CONTEXT:
-{context}
-
-QUESTION:
-{question}
-
 Return:
 - Answer (5-10 bullet points)
 - Causes / risk factors (if in context)
@@ -14,3 +11,10 @@ Return:
 
 Do NOT include any URLs in the answer.
 """
+
+VANILLA_USER_TEMPLATE = """CONTEXT:
+{context}
+
+QUESTION:
+{question}
+"""
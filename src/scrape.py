@@ -2,18 +2,21 @@
 from __future__ import annotations
 
 import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse, urlunparse
 
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
 
 # ----------------------------
 # Text cleaning
 # ----------------------------
-def _clean_text(html: str) -> str:
-    soup = BeautifulSoup(html, "lxml")
-
+def _extract_text(soup: BeautifulSoup) -> str:
+    """Visible text of an already-parsed page. Mutates `soup`."""
     # remove junk
     for tag in soup(["script", "style", "noscript", "svg"]):
         tag.decompose()
@@ -27,31 +30,21 @@ def _clean_text(html: str) -> str:
 # ----------------------------
 # URL rules for MedlinePlus
 # ----------------------------
-AZ_INDEX_RE = re.compile(r"/healthtopics_[a-z]\.html$", re.IGNORECASE)
-
-# Anything that is usually not a "topic page"
-SKIP_PATH_PARTS = (
-    "/about/",
-    "/ency/",
-    "/genetics/",
-    "/laboratory/",
-    "/magazine/",
-    "/multiplelanguages/",
-    "/news/",
-    "/all_easytoread.html",
-    "/all_healthtopics.html",
-    "/all_howto.html",
-    "/sitemap",
+# Anything that is usually not a "topic page", as ONE pattern (one scan per path)
+SKIP_RE = re.compile(
+    r"\.(?:pdf|png|jpe?g|gif|svg|webp|zip)$"  # file types / assets
+    r"|/healthtopics_[a-z]\.html$"  # A-Z index pages
+    r"|/(?:about|ency|genetics|laboratory|magazine|multiplelanguages|news)/"
+    r"|/all_(?:easytoread|healthtopics|howto)\.html"
+    r"|/sitemap",
+    re.IGNORECASE,
 )
 
-# File types to skip
-SKIP_EXT_RE = re.compile(r"\.(pdf|png|jpg|jpeg|gif|svg|webp|zip)$", re.IGNORECASE)
-
 
 def _canonicalize(u: str) -> str:
-    """Remove fragments, normalize, and drop trailing slash."""
+    """Remove fragments, lowercase scheme/host, and drop trailing slash."""
     p = urlparse(u)
-    p = p._replace(fragment="", query="")  # drop #... and ?...
+    p = p._replace(scheme=p.scheme.lower(), netloc=p.netloc.lower(), fragment="", query="")  # drop #... and ?...
     canon = urlunparse(p)
     if canon.endswith("/") and len(canon) > len("https://x/"):
         canon = canon[:-1]
@@ -76,16 +69,8 @@ def _is_good_topic_url(seed_netloc: str, u: str) -> bool:
     p = urlparse(u)
     path = (p.path or "").lower()
 
-    # skip non-html / assets
-    if SKIP_EXT_RE.search(path):
-        return False
-
-    # skip A-Z index pages
-    if AZ_INDEX_RE.search(path):
-        return False
-
-    # skip known non-topic sections
-    if any(part in path for part in SKIP_PATH_PARTS):
+    # skip assets, A-Z index pages and known non-topic sections
+    if SKIP_RE.search(path):
         return False
 
     # must be a simple one-level .html page: "/insomnia.html"
@@ -105,26 +90,45 @@ def _is_good_topic_url(seed_netloc: str, u: str) -> bool:
 # ----------------------------
 # Crawl
 # ----------------------------
+def _fetch(session: requests.Session, url: str) -> tuple[str, str | None]:
+    """GET one page; returns (url, html) or (url, None) if unusable."""
+    try:
+        r = session.get(url, timeout=25)
+    except requests.RequestException:
+        return url, None
+
+    ctype = r.headers.get("Content-Type", "")
+    if r.status_code != 200 or "text/html" not in ctype:
+        return url, None
+    return url, r.text
+
+
 def crawl_site(
     seed_url: str,
     max_pages: int = 60,
     extra_seeds: list[str] | None = None,
+    workers: int = 8,
+    wave_delay: float = 0.25,
 ) -> list[dict]:
     """
     Returns: list of {"url":..., "text":...}
     MedlinePlus-tuned crawler: collects topic pages only.
+    Fetches the frontier in waves of up to `workers` parallel GETs,
+    pausing `wave_delay` seconds between waves to stay polite.
     """
     seed = urlparse(seed_url)
-    seed_netloc = seed.netloc
+    seed_netloc = seed.netloc.lower()  # matches _canonicalize
 
     seen: set[str] = set()
-    queue: list[str] = []
+    queue: deque[str] = deque()
+    queued: set[str] = set()  # everything ever pushed, for O(1) membership
 
     # Put the best candidates first
     def push(u: str):
         cu = _canonicalize(u)
-        if cu and cu not in seen and cu not in queue:
+        if cu and cu not in seen and cu not in queued:
             queue.append(cu)
+            queued.add(cu)
 
     push(seed_url)
 
@@ -141,44 +145,53 @@ def crawl_site(
             "Accept": "text/html,application/xhtml+xml",
         }
     )
-
-    while queue and len(pages) < max_pages:
-        url = queue.pop(0)
-        if url in seen:
-            continue
-        seen.add(url)
-
-        # filter BEFORE request
-        if not _is_good_topic_url(seed_netloc, url):
-            continue
-
-        try:
-            r = session.get(url, timeout=25)
-        except requests.RequestException:
-            continue
-
-        ctype = r.headers.get("Content-Type", "")
-        if r.status_code != 200 or "text/html" not in ctype:
-            continue
-
-        text = _clean_text(r.text)
-
-        # Raise minimum a bit so we avoid very thin pages
-        if len(text) < 800:
-            continue
-
-        pages.append({"url": url, "text": text})
-
-        # Extract more topic links from this page
-        soup = BeautifulSoup(r.text, "lxml")
-        for a in soup.select("a[href]"):
-            nxt = urljoin(url, a.get("href", ""))
-            nxt = _canonicalize(nxt)
-
-            # Only add if it's a good topic page
-            if _is_good_topic_url(seed_netloc, nxt):
-                # Keep queue from exploding
-                if len(queue) < max_pages * 6:
-                    push(nxt)
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers * 2)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        while queue and len(pages) < max_pages:
+            # Next wave: don't fetch more than we could still keep
+            batch: list[str] = []
+            wave_size = min(workers, max_pages - len(pages))
+            while queue and len(batch) < wave_size:
+                url = queue.popleft()
+                if url in seen:
+                    continue
+                seen.add(url)
+
+                # filter BEFORE request
+                if _is_good_topic_url(seed_netloc, url):
+                    batch.append(url)
+
+            # map() keeps frontier order, so results match a serial crawl
+            for url, html in ex.map(lambda u: _fetch(session, u), batch):
+                if html is None or len(pages) >= max_pages:
+                    continue
+
+                # Parse once; grab links before _extract_text() decomposes tags
+                soup = BeautifulSoup(html, "lxml")
+                hrefs = [a.get("href", "") for a in soup.select("a[href]")]
+                text = _extract_text(soup)
+
+                # Raise minimum a bit so we avoid very thin pages
+                if len(text) < 800:
+                    continue
+
+                pages.append({"url": url, "text": text})
+
+                # Extract more topic links from this page
+                for href in hrefs:
+                    nxt = urljoin(url, href)
+                    nxt = _canonicalize(nxt)
+
+                    # Only add if it's a good topic page
+                    if _is_good_topic_url(seed_netloc, nxt):
+                        # Keep queue from exploding
+                        if len(queue) < max_pages * 6:
+                            push(nxt)
+
+            if batch and queue and len(pages) < max_pages:
+                time.sleep(wave_delay)
 
     return pages
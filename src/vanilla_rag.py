@@ -3,31 +3,60 @@ from __future__ import annotations
 
 import sys
 import re
-from typing import List, Tuple, Dict
-from dotenv import load_dotenv
-
-from langchain_openai import ChatOpenAI
-from langchain_community.vectorstores import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_core.documents import Document
+import heapq
+import json
+import time
+import sqlite3
+from contextlib import closing
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Heavy deps (langchain -> chromadb / onnxruntime) are imported lazily inside
+# the functions that need them, so the CLI starts fast and can reject an
+# empty question without loading them.
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from langchain_community.vectorstores import Chroma
+    from langchain_core.documents import Document
 
 # Import prompts
 try:
-    from prompts import VANILLA_TEMPLATE
+    from prompts import VANILLA_SYSTEM_PROMPT, VANILLA_USER_TEMPLATE
 except ImportError:
-    VANILLA_TEMPLATE = """Use the following context to answer the question.
-
-CONTEXT:
+    VANILLA_SYSTEM_PROMPT = "Use the following context to answer the question."
+    VANILLA_USER_TEMPLATE = """CONTEXT:
 {context}
 
 QUESTION:
 {question}
 """
 
-QUESTION_MARKERS = [
-    r"\bQUESTION:\s*",
-    r"\bNew question:\s*",
-]
+# Headings + formatting rules, appended whatever prompts.py provides
+_SYSTEM_PROMPT = VANILLA_SYSTEM_PROMPT.rstrip() + """
+
+CRITICAL REQUIREMENTS:
+- Use ONLY the provided MedlinePlus context.
+- Use these headings EXACTLY:
+
+1) Overview
+2) Causes / Risk Factors
+3) Symptoms
+4) Diagnosis
+5) Treatment / What You Can Do
+6) When to Seek Urgent Care
+
+FORMATTING RULES (VERY IMPORTANT):
+- Do NOT add blank lines between a heading and its content.
+- Do NOT add blank lines between bullet points.
+- If a section is missing in context, write exactly:
+  Not enough information in the retrieved pages.
+- Do NOT include URLs in the answer body.
+- Do NOT use outside knowledge.
+"""
+
+# Both question markers in ONE compiled pattern (single scan per call)
+_MARKERS_RE = re.compile(r"\bQUESTION:\s*|\bNew question:\s*", re.IGNORECASE)
+_BLANK3_RE = re.compile(r"\n{3,}")
+_HEADING_RE = re.compile(r"\d+\)\s")  # "1) Overview"
 
 
 # ----------------------------
@@ -43,43 +72,96 @@ def _extract_last_question(stdin_text: str) -> str:
     if "\n" not in t and len(t) < 400:
         return t.strip()
 
-    last_pos = -1
-    last_marker_len = 0
-
-    for pat in QUESTION_MARKERS:
-        matches = list(re.finditer(pat, t, flags=re.IGNORECASE))
-        if matches:
-            pos = matches[-1].start()
-            if pos > last_pos:
-                last_pos = pos
-                last_marker_len = len(matches[-1].group(0))
+    # Fast path: plain rfind for the last marker ("new question:" ends with
+    # "question:", so one search covers both). Only trusted when it sits on
+    # a word boundary and lower() kept the indices aligned; else use the regex.
+    tl = t.lower()
+    pos = tl.rfind("question:")
+    prev = tl[pos - 1] if pos > 0 else " "
+    if pos >= 0 and not (prev.isalnum() or prev == "_") and len(tl) == len(t):
+        last_end = pos + 9
+    else:
+        last_end = -1
+        for m in _MARKERS_RE.finditer(t):
+            last_end = m.end()
 
-    if last_pos >= 0:
-        q = t[last_pos + last_marker_len :].strip()
+    if last_end >= 0:
+        q = t[last_end:].strip()
     else:
         lines = [x.strip() for x in t.splitlines() if x.strip()]
         q = lines[-1] if lines else ""
 
-    q = re.sub(r"\s+", " ", q).strip()
-    return q
+    return " ".join(q.split())
 
 
 # ----------------------------
-# Retrieval helpers
+# Retrieval cache (on disk, survives CLI runs)
 # ----------------------------
-def _cap(text: str, max_chars: int = 8000) -> str:
-    return (text or "")[:max_chars]
+_RETRIEVAL_CACHE_PATH = ".retrieval_cache.db"
+_RETRIEVAL_CACHE_TTL = 24 * 3600  # seconds
+
+
+def _db_version(db: Chroma) -> str:
+    """Changes whenever chroma_db (or the FAISS export) is rebuilt."""
+    if hasattr(db, "version"):  # FaissStore
+        return db.version
+    coll = db._collection
+    return f"{coll.id}:{coll.count()}"
 
 
-def _base_url(url: str) -> str:
-    return (url or "").split("#")[0].strip()
+def _open_retrieval_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(_RETRIEVAL_CACHE_PATH, timeout=5)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS r(q TEXT PRIMARY KEY, ts REAL, version TEXT, blob BLOB)"
+    )
+    return conn
 
 
-def _is_medline_url(url: str) -> bool:
-    u = (url or "").lower()
-    return u.startswith("http") and "medlineplus.gov" in u
+def _cached_grouped(db: Chroma, question: str, k: int) -> List[Tuple[Document, float, str]]:
+    """
+    _group_best_chunk_per_url(similarity search), persisted in SQLite keyed by
+    (normalized question, k). Hits skip the query embedding and the vector
+    search entirely. Entries expire after a TTL or when the DB version changes.
+    """
+    key = f"{k}|{' '.join(question.lower().split())}"
+    version = _db_version(db)
+
+    try:
+        with closing(_open_retrieval_cache()) as conn:
+            row = conn.execute("SELECT ts, version, blob FROM r WHERE q = ?", (key,)).fetchone()
+    except sqlite3.Error:
+        row = None
+
+    if row and row[1] == version and time.time() - row[0] < _RETRIEVAL_CACHE_TTL:
+        from langchain_core.documents import Document
+
+        return [
+            (Document(page_content=c, metadata=m), s, url)
+            for c, m, s, url in json.loads(row[2])
+        ]
+
+    # Embed explicitly: embed_query is memoized (see embeddings.py)
+    vec = db.embeddings.embed_query(question)
+    grouped = _group_best_chunk_per_url(
+        db.similarity_search_by_vector_with_relevance_scores(vec, k=k)
+    )
+
+    blob = json.dumps([(d.page_content, d.metadata, s, url) for d, s, url in grouped])
+    try:
+        with closing(_open_retrieval_cache()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO r(q, ts, version, blob) VALUES (?, ?, ?, ?)",
+                (key, time.time(), version, blob),
+            )
+    except sqlite3.Error as e:
+        print(f"WARNING: retrieval cache write failed: {e}", file=sys.stderr)
+
+    return grouped
 
 
+# ----------------------------
+# Retrieval helpers
+# ----------------------------
 def _group_best_chunk_per_url(
     results: List[Tuple[Document, float]]
 ) -> List[Tuple[Document, float, str]]:
@@ -88,12 +170,21 @@ def _group_best_chunk_per_url(
     Returns list of (doc, score, base_url) sorted by score asc.
     """
     best: Dict[str, Tuple[Document, float]] = {}
+    best_get = best.get  # hoisted: this loop runs over 400+ hits
 
     for d, s in results:
-        url = _base_url((d.metadata.get("source") or "").strip())
-        if not url or not _is_medline_url(url):
+        meta = d.metadata
+        url = meta.get("source")  # canonical page URL (crawler strips fragments)
+        if not url:
+            continue
+        medline = meta.get("is_medline")
+        if medline is None:  # chunk ingested before is_medline was stored
+            # hosts are lowercased by the crawler, so a substring test suffices
+            medline = "medlineplus.gov" in url
+        if not medline:
             continue
-        if url not in best or s < best[url][1]:
+        cur = best_get(url)
+        if cur is None or s < cur[1]:
             best[url] = (d, s)
 
     grouped = [(doc, score, url) for url, (doc, score) in best.items()]
@@ -105,19 +196,9 @@ def _select_top_k_relevant_unique(
     grouped: List[Tuple[Document, float, str]],
     k_unique: int = 5,
 ) -> List[Tuple[Document, float, str]]:
-    
-    if not grouped:
-        return []
-
-    best_score = grouped[0][1]
-    margins = [0.15, 0.30, 0.50, 0.80, 1.20, 2.00, 3.00]
-
-    for m in margins:
-        gate = best_score + m
-        picked = [t for t in grouped if t[1] <= gate][:k_unique]
-        if len(picked) >= k_unique:
-            return picked
-
+    # grouped is sorted by score asc, so every margin gate selects a prefix
+    # of it and the first gate holding k_unique items picks grouped[:k_unique]
+    # (as does the no-gate fall-through): the margin scan never changed the picks
     return grouped[:k_unique]
 
 
@@ -127,84 +208,100 @@ def _build_context(
     per_source_chars: int = 1400,
 ) -> str:
     
-    parts = []
+    # Truncate BEFORE cleaning (no regex over text that gets cut anyway),
+    # and stop writing once max_chars is reached.
+    parts: List[str] = []
+    total = 0
     for d, s, url in picked:
-        text = (d.page_content or "").strip()
-        text = re.sub(r"\n{3,}", "\n\n", text)
-        text = text[:per_source_chars]
-        parts.append(f"SOURCE: {url}\n{text}")
-    return _cap("\n\n".join(parts), max_chars=max_chars)
+        text = (d.page_content or "").strip()[:per_source_chars]
+        text = _BLANK3_RE.sub("\n\n", text)
+        piece = f"SOURCE: {url}\n{text}"
+        if parts:
+            piece = "\n\n" + piece
+        room = max_chars - total
+        if len(piece) >= room:
+            parts.append(piece[:room])
+            break
+        parts.append(piece)
+        total += len(piece)
+    return "".join(parts)
 
 
 # ----------------------------
 # Output formatting (NO blank lines like Agentic)
 # ----------------------------
 def _tighten_answer(text: str) -> str:
-    
-    t = (text or "").replace("\r\n", "\n")
-
-    # strip trailing whitespace per line
-    t = "\n".join(line.rstrip() for line in t.splitlines())
-
-    # collapse 3+ newlines => 2 newlines
-    t = re.sub(r"\n{3,}", "\n\n", t)
-
-    # remove blank lines immediately after a heading like "1) Overview"
-    t = re.sub(r"(?m)^(\d+\)\s[^\n]+)\n\s*\n+", r"\1\n", t)
-
-    # remove blank lines BEFORE bullet points
-    t = re.sub(r"\n\s*\n(\s*[-•]\s+)", r"\n\1", t)
-
-    # remove blank lines BETWEEN bullet points
-    t = re.sub(r"(?m)^(\s*[-•]\s+.*)\n\s*\n(\s*[-•]\s+)", r"\1\n\2", t)
+    """
+    One pass over the lines: strip trailing whitespace, keep at most ONE
+    blank line between blocks, and drop it entirely after a heading like
+    "1) Overview" or before a bullet point.
+    """
+    out: List[str] = []
+    pending_blank = False  # a blank run was seen since the last kept line
+    after_heading = False
+
+    for line in (text or "").splitlines():
+        line = line.rstrip()
+        if not line:
+            pending_blank = True
+            continue
 
-    # make sure sections are separated by exactly ONE blank line max
-    # (i.e., one empty line = "\n\n" is okay, but not more)
-    t = re.sub(r"\n{3,}", "\n\n", t)
+        head = line.lstrip()[:2]
+        bullet = head[:1] in ("-", "•") and head[1:].isspace()
+        if pending_blank and out and not after_heading and not bullet:
+            out.append("")
+        out.append(line)
+        pending_blank = False
+        after_heading = _HEADING_RE.match(line) is not None
 
-    return t.strip()
+    return "\n".join(out).strip()
 
 
 # ----------------------------
 # LLM answer
 # ----------------------------
-def generate_structured_answer(llm: ChatOpenAI, question: str, context: str) -> str:
+# Fixed answer when nothing usable was retrieved (no prompt, no LLM call)
+_NOT_ENOUGH_RAW = (
+    "1) Overview\nNot enough information in the retrieved pages.\n"
+    "2) Causes / Risk Factors\nNot enough information in the retrieved pages.\n"
+    "3) Symptoms\nNot enough information in the retrieved pages.\n"
+    "4) Diagnosis\nNot enough information in the retrieved pages.\n"
+    "5) Treatment / What You Can Do\nNot enough information in the retrieved pages.\n"
+    "6) When to Seek Urgent Care\nNot enough information in the retrieved pages.\n"
+)
+_NOT_ENOUGH_ANSWER = _tighten_answer(_NOT_ENOUGH_RAW)
+
+
+def generate_structured_answer_stream(llm: ChatOpenAI, question: str, context: str) -> Iterator[str]:
+    """Yield raw answer tokens as the model produces them (not tightened)."""
     if not context.strip():
-        return _tighten_answer(
-            "1) Overview\nNot enough information in the retrieved pages.\n"
-            "2) Causes / Risk Factors\nNot enough information in the retrieved pages.\n"
-            "3) Symptoms\nNot enough information in the retrieved pages.\n"
-            "4) Diagnosis\nNot enough information in the retrieved pages.\n"
-            "5) Treatment / What You Can Do\nNot enough information in the retrieved pages.\n"
-            "6) When to Seek Urgent Care\nNot enough information in the retrieved pages.\n"
-        )
+        yield _NOT_ENOUGH_RAW
+        return
 
-    prompt = VANILLA_TEMPLATE.format(context=context, question=question) + """
+    # static instructions as the system message, context + question as the user turn
+    messages = [
+        ("system", _SYSTEM_PROMPT),
+        ("human", VANILLA_USER_TEMPLATE.format(context=context, question=question)),
+    ]
 
-CRITICAL REQUIREMENTS:
-- Use ONLY the provided MedlinePlus context above.
-- Use these headings EXACTLY:
-
-1) Overview
-2) Causes / Risk Factors
-3) Symptoms
-4) Diagnosis
-5) Treatment / What You Can Do
-6) When to Seek Urgent Care
-
-FORMATTING RULES (VERY IMPORTANT):
-- Do NOT add blank lines between a heading and its content.
-- Do NOT add blank lines between bullet points.
-- If a section is missing in context, write exactly:
-  Not enough information in the retrieved pages.
-- Do NOT include URLs in the answer body.
-- Do NOT use outside knowledge.
+    for chunk in llm.stream(messages):
+        if chunk.content:
+            yield chunk.content
 
-Now answer the question:
-"""
 
-    out = llm.invoke(prompt).content
-    return _tighten_answer(out)
+def generate_structured_answer(
+    llm: ChatOpenAI,
+    question: str,
+    context: str,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """Stream the answer (forwarding tokens to `on_token`), tighten once at the end."""
+    parts: List[str] = []
+    for tok in generate_structured_answer_stream(llm, question, context):
+        parts.append(tok)
+        if on_token is not None:
+            on_token(tok)
+    return _tighten_answer("".join(parts))
 
 
 def format_sources_output(picked: List[Tuple[Document, float, str]]) -> str:
@@ -217,53 +314,103 @@ def format_sources_output(picked: List[Tuple[Document, float, str]]) -> str:
     return "\n".join(lines)
 
 
-def main():
-    # Ensure UTF-8 output
-    if sys.stdout.encoding != "utf-8":
-        sys.stdout.reconfigure(encoding="utf-8", errors="replace")
-    if sys.stderr.encoding != "utf-8":
-        sys.stderr.reconfigure(encoding="utf-8", errors="replace")
+def retrieve_picks(question: str, db: Chroma) -> List[Tuple[Document, float, str]]:
+    """Top unique MedlinePlus chunks for an already-extracted question."""
+    # Retrieve one big pool; it nearly always covers 5+ distinct pages
+    grouped1 = _cached_grouped(db, question, k=400)
+    picked = _select_top_k_relevant_unique(grouped1, k_unique=5)
 
-    load_dotenv()
+    # Only if there are truly < 5 distinct MedlinePlus URLs, do a light expansion
+    if len(grouped1) < 5:
+        expanded = f"{question} symptoms causes diagnosis treatment"
+        grouped2 = _cached_grouped(db, expanded, k=260)
+
+        # Both lists are sorted by score, so a linear merge keeps order and
+        # the first time a URL shows up is its best score (no re-sort needed)
+        seen: set = set()
+        merged_list: List[Tuple[Document, float, str]] = []
+        for t in heapq.merge(grouped1, grouped2, key=lambda x: x[1]):
+            if t[2] in seen:
+                continue
+            seen.add(t[2])
+            merged_list.append(t)
 
-    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+        picked = _select_top_k_relevant_unique(merged_list, k_unique=5)
+
+    return picked
+
+
+def answer(
+    question: str,
+    llm: ChatOpenAI,
+    db: Chroma,
+    on_token: Optional[Callable[[str], None]] = None,
+) -> str:
+    """
+    Run the vanilla pipeline with already-loaded LLM + vector store.
+    Accepts a bare question or the app's multi-line prompt block.
+    Raw answer tokens are passed to `on_token` as they stream in.
+    Returns the tightened answer + sources (the CLI prints the raw
+    streamed tokens instead, so its output can differ in blank lines).
+    """
+    question = _extract_last_question(question)
+    if not question:
+        raise ValueError("No question provided")
+
+    picked = retrieve_picks(question, db)
+    if not picked:
+        if on_token:
+            on_token(_NOT_ENOUGH_ANSWER)
+        return f"\nAnswer\n\n{_NOT_ENOUGH_ANSWER}\n{format_sources_output(picked)}"
+
+    context = _build_context(picked, max_chars=8000, per_source_chars=1400)
+    answer_text = generate_structured_answer(llm, question, context, on_token=on_token)
 
-    emb = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-    db = Chroma(persist_directory="chroma_db", embedding_function=emb)
+    return f"\nAnswer\n\n{answer_text}\n{format_sources_output(picked)}"
 
-    raw_in = sys.stdin.read()
+
+def _write_token(tok: str) -> None:
+    # Raw UTF-8 bytes: no reliance on the console codec or stream reconfigure
+    sys.stdout.buffer.write(tok.encode("utf-8", "replace"))
+    sys.stdout.flush()
+
+
+def main():
+    # Decode stdin once as UTF-8 (the app always sends UTF-8)
+    raw_in = sys.stdin.buffer.read().decode("utf-8", "replace")
     question = _extract_last_question(raw_in)
 
     if not question:
         print("ERROR: No question provided", file=sys.stderr)
         sys.exit(1)
 
-    # Retrieve big pool
-    raw1 = db.similarity_search_with_score(question, k=220)
-    grouped1 = _group_best_chunk_per_url(raw1)
-    picked = _select_top_k_relevant_unique(grouped1, k_unique=5)
+    from dotenv import load_dotenv
+    from embeddings import load_embeddings
+    from faiss_store import load_vector_store
 
-    # If still not enough, do a light expansion
-    if len(picked) < 5:
-        expanded = f"{question} symptoms causes diagnosis treatment"
-        raw2 = db.similarity_search_with_score(expanded, k=260)
-        grouped2 = _group_best_chunk_per_url(raw2)
+    load_dotenv()
 
-        merged: Dict[str, Tuple[Document, float, str]] = {}
-        for d, s, u in (grouped1 + grouped2):
-            if u not in merged or s < merged[u][1]:
-                merged[u] = (d, s, u)
+    emb = load_embeddings()
+    db = load_vector_store(emb)  # FAISS export if built, else chroma_db
 
-        merged_list = list(merged.values())
-        merged_list.sort(key=lambda x: x[1])
-        picked = _select_top_k_relevant_unique(merged_list, k_unique=5)
+    picked = retrieve_picks(question, db)
+    sources = format_sources_output(picked)  # ready before the LLM starts
+
+    # Nothing retrieved: fixed answer, no prompt and no OpenAI round-trip
+    if not picked:
+        _write_token(f"\nAnswer\n\n{_NOT_ENOUGH_ANSWER}\n{sources}\n")
+        return
+
+    from langchain_openai import ChatOpenAI
 
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
     context = _build_context(picked, max_chars=8000, per_source_chars=1400)
-    answer = generate_structured_answer(llm, question, context)
 
-    print("\nAnswer\n")
-    print(answer)
-    print(format_sources_output(picked))
+    # Stream tokens as they arrive (shown as generated, not tightened)
+    _write_token("\nAnswer\n\n")
+    for tok in generate_structured_answer_stream(llm, question, context):
+        _write_token(tok)
+    _write_token(f"\n{sources}\n")
 
 
 if __name__ == "__main__":